@@ -1,15 +1,26 @@
 import os
+import json
+import asyncio
+import inspect
+import time
+import threading
 import docker
-from typing import TypedDict, Annotated, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict, Annotated, List, Optional, Union
 from langgraph.graph import StateGraph, END
+from langgraph.constants import Send
 print("DEBUG: Imported StateGraph", flush=True)
 from langchain_openai import ChatOpenAI
 print("DEBUG: Imported ChatOpenAI", flush=True)
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, RemoveMessage, ToolMessage
 from langchain_core.tools import tool
 print("DEBUG: Imported langchain_core", flush=True)
-from vector_store import rag_engine
-print("DEBUG: Imported rag_engine", flush=True)
+from vector_store import get_rag_engine, on_index_change, LANGUAGES
+print("DEBUG: Imported vector_store", flush=True)
+from semantic_cache import SemanticCache
+from file_tree import invalidate_tree
+from shell_pool import shell_pool
+from file_io import write_text
 
 from langgraph.graph.message import add_messages
 
@@ -19,9 +30,20 @@ class AgentState(TypedDict):
     plan: List[str]
     current_task: str
     tool_calls: List[dict]
-    last_tool_output: str
+    last_tool_ok: bool
     error: str
 
+class ToolResult(TypedDict):
+    """What every tool returns: a success flag plus the text the LLM sees."""
+    ok: bool
+    output: str
+
+def tool_ok(output: str) -> ToolResult:
+    return {"ok": True, "output": output}
+
+def tool_error(output: str) -> ToolResult:
+    return {"ok": False, "output": output}
+
 # --- Setup Docker ---
 try:
     docker_client = docker.from_env()
@@ -38,7 +60,11 @@ def set_active_project(path: str):
     ACTIVE_PROJECT_PATH = path
     print(f"Agent switching to project: {ACTIVE_PROJECT_PATH}")
     
+    # Cached hits belong to the previous project
+    search_cache.clear()
+
     # Remove existing container so new one is created with correct mount
+    invalidate_sandbox()
     if docker_client:
         try:
             old_container = docker_client.containers.get(CONTAINER_NAME)
@@ -49,9 +75,28 @@ def set_active_project(path: str):
         except Exception as e:
             print(f"Error removing sandbox: {e}")
 
+# Container handle is reused for a few seconds instead of asking the daemon on every tool call
+SANDBOX_RECHECK_SECONDS = 5.0
+_sandbox_cache = {"container": None, "checked_at": 0.0}
+_sandbox_lock = threading.Lock()
+
+def invalidate_sandbox():
+    _sandbox_cache["container"] = None
+    _sandbox_cache["checked_at"] = 0.0
+
 def get_sandbox():
     if not docker_client:
         return None
+    with _sandbox_lock:
+        if (_sandbox_cache["container"] is not None and
+                time.monotonic() - _sandbox_cache["checked_at"] < SANDBOX_RECHECK_SECONDS):
+            return _sandbox_cache["container"]
+        container = _lookup_sandbox()
+        _sandbox_cache["container"] = container
+        _sandbox_cache["checked_at"] = time.monotonic()
+        return container
+
+def _lookup_sandbox():
     try:
         container = docker_client.containers.get(CONTAINER_NAME)
         if container.status != "running":
@@ -72,12 +117,60 @@ def get_sandbox():
             print(f"Failed to start docker container: {e}")
             return None
 
+# --- Search Cache ---
+SEARCH_LANGUAGES = frozenset(LANGUAGES.values())
+# Near-duplicate queries (e.g. retries after the verifier loop) reuse earlier hits
+search_cache = SemanticCache(
+    embed_fn=lambda query: get_rag_engine().embed_query(query),
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "search_cache")
+)
+# Re-ingesting changes what a search returns
+on_index_change(search_cache.clear)
+
 # --- Tools ---
+def search_scope(language: Optional[str] = None):
+    """(repo, lang) filter for searches from the agent: the active project, plus a known language."""
+    lang = language.lower() if isinstance(language, str) else None
+    return os.path.abspath(ACTIVE_PROJECT_PATH), (lang if lang in SEARCH_LANGUAGES else None)
+
+def cached_search(queries: List[str], language: Optional[str] = None):
+    """Search several queries, serving cache hits and batching the misses into one RAG call."""
+    rag_engine = get_rag_engine()
+    repo, lang = search_scope(language)
+    # Results depend on the filter, so cache entries are scoped by it too
+    namespace = f"{repo}|{lang or ''}"
+    if not rag_engine.embeddings:
+        return [str(rag_engine.search(q, repo=repo, lang=lang)) for q in queries]
+    # One batched embed serves both the semantic lookups and the search for the misses
+    try:
+        vectors = rag_engine.embed_queries(queries)
+    except Exception as e:
+        return [f"Search error: {e}"] * len(queries)
+
+    results = [search_cache.lookup(q, namespace, vector=v) for q, v in zip(queries, vectors)]
+    misses = [i for i, res in enumerate(results) if res is None]
+    if misses:
+        fresh = rag_engine.search_batch(
+            [queries[i] for i in misses], repo=repo, lang=lang,
+            vectors=[vectors[i] for i in misses]
+        )
+        for i, res in zip(misses, fresh):
+            results[i] = str(res)
+            if search_succeeded(results[i]):
+                search_cache.store(queries[i], results[i], namespace, vector=vectors[i])
+    return results
+
+def search_succeeded(output: str):
+    return not output.startswith(("Search error:", "RAG functionality is unavailable"))
+
+def search_result(output: str) -> ToolResult:
+    return tool_ok(output) if search_succeeded(output) else tool_error(output)
+
 @tool
-def search_codebase(query: str):
-    """Search the codebase for relevant files and code snippets."""
-    results = rag_engine.search(query)
-    return str(results)
+def search_codebase(query: str, language: Optional[str] = None):
+    """Search the current project for relevant files and code snippets.
+    Optionally restrict to one language: python, javascript, html, css, markdown, text, yaml or json."""
+    return search_result(cached_search([query], language)[0])
 
 @tool
 def run_shell(command: str, background: bool = False):
@@ -90,12 +183,14 @@ def run_shell(command: str, background: bool = False):
         try:
             if background:
                 container.exec_run(command, detach=True)
-                return "Command started in background."
+                return tool_ok("Command started in background.")
             else:
                 exec_log = container.exec_run(command)
-                return exec_log.output.decode("utf-8")
+                output = exec_log.output.decode("utf-8")
+                return tool_ok(output) if exec_log.exit_code == 0 else tool_error(output)
         except Exception as e:
-            return f"Error executing command in docker: {e}"
+            invalidate_sandbox() # Container may have gone away; look it up again next time
+            return tool_error(f"Error executing command in docker: {e}")
     else:
         # Fallback to local execution
         import subprocess
@@ -109,18 +204,13 @@ def run_shell(command: str, background: bool = False):
                     stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL
                 )
-                return f"Command started in background (PID: {proc.pid})."
+                return tool_ok(f"Command started in background (PID: {proc.pid}).")
             else:
-                result = subprocess.run(
-                    command, 
-                    shell=True, 
-                    capture_output=True, 
-                    text=True, 
-                    cwd=ACTIVE_PROJECT_PATH
-                )
-                return result.stdout + result.stderr
+                # Reuse a warm shell instead of spawning one per command
+                exit_code, output = shell_pool.run(command, ACTIVE_PROJECT_PATH)
+                return tool_ok(output) if exit_code == 0 else tool_error(output)
         except Exception as e:
-            return f"Error executing local command: {e}"
+            return tool_error(f"Error executing local command: {e}")
 
 @tool
 def write_file(path: str, content: str):
@@ -130,50 +220,69 @@ def write_file(path: str, content: str):
     # The prompt says: "The Agent NEVER runs code on the host machine. All subprocess calls must go through docker..."
     # Writing files to the mounted volume is safe and efficient.
     full_path = os.path.join(ACTIVE_PROJECT_PATH, path)
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-    with open(full_path, "w") as f:
-        f.write(content)
-    return f"Wrote to {path}"
+    try:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        write_text(full_path, content)
+    except Exception as e:
+        return tool_error(f"Error writing file: {e}")
+    invalidate_tree(full_path)
+    return tool_ok(f"Wrote to {path}")
 
 @tool
 def read_file(path: str):
     """Read the content of a file."""
     full_path = os.path.join(ACTIVE_PROJECT_PATH, path)
-    if not os.path.exists(full_path):
-        return f"Error: File {path} does not exist."
     try:
         with open(full_path, "r", encoding="utf-8") as f:
-            return f.read()
+            return tool_ok(f.read())
+    except FileNotFoundError:
+        return tool_error(f"Error: File {path} does not exist.")
     except Exception as e:
-        return f"Error reading file: {e}"
+        return tool_error(f"Error reading file: {e}")
 
 @tool
 def list_files(path: str = "."):
     """List files in a directory."""
     full_path = os.path.join(ACTIVE_PROJECT_PATH, path)
-    if not os.path.exists(full_path):
-        return f"Error: Directory {path} does not exist."
     try:
         entries = []
-        for entry in os.scandir(full_path):
-            if entry.name.startswith('.') and len(entry.name) > 1: continue 
-            if 'node_modules' in entry.name or '__pycache__' in entry.name: continue
-            
-            type_str = "DIR" if entry.is_dir() else "FILE"
-            entries.append(f"{type_str}: {entry.name}")
-        return "\n".join(sorted(entries))
+        with os.scandir(full_path) as it:
+            for entry in it:
+                if entry.name.startswith('.') and len(entry.name) > 1: continue 
+                if 'node_modules' in entry.name or '__pycache__' in entry.name: continue
+                
+                type_str = "DIR" if entry.is_dir() else "FILE"
+                entries.append(f"{type_str}: {entry.name}")
+        return tool_ok("\n".join(sorted(entries)))
+    except FileNotFoundError:
+        return tool_error(f"Error: Directory {path} does not exist.")
     except Exception as e:
-        return f"Error listing directory: {e}"
+        return tool_error(f"Error listing directory: {e}")
 
 tools = [search_codebase, run_shell, write_file, read_file, list_files]
 llm = ChatOpenAI(model="gpt-4o").bind_tools(tools)
 
 # --- Nodes ---
+planner_llm = ChatOpenAI(model="gpt-4o")
+
+PLANNER_PROMPT = """Split the user's latest request into independent subtasks that can be worked on in parallel.
+Respond with ONLY a JSON array of short task descriptions.
+If the request is a single task, a follow-up/confirmation, or its steps depend on each other, return a single-item array."""
+
 def planner_node(state: AgentState):
     messages = state['messages']
-    # Simple planner: just keeps the messages logic or we could have a dedicated planner LLM
-    # For now, we'll let the Executor handle the planning implicitly via conversation
-    return {"plan": ["Execute user request"]} 
+    if not messages or not isinstance(messages[-1], HumanMessage):
+        return {"plan": ["Execute user request"]}
+    try:
+        response = planner_llm.invoke([SystemMessage(content=PLANNER_PROMPT), messages[-1]])
+        plan = json.loads(response.content)
+        if not isinstance(plan, list) or not plan:
+            raise ValueError("Planner returned an empty plan")
+        plan = [str(task) for task in plan]
+    except Exception as e:
+        print(f"Planner fallback: {e}")
+        plan = ["Execute user request"]
+    return {"plan": plan}
 
 def executor_node(state: AgentState):
     messages = state['messages']
@@ -199,49 +308,114 @@ RULES:
     
     # Prepend system prompt to the conversation if not already there (simplified check)
     # Actually, for every invoke, we can just pass [system_prompt] + messages
+    if state.get('current_task'):
+        system_prompt = SystemMessage(content=system_prompt.content + f"""
+You are working on ONE of several subtasks that run in parallel. Only handle this subtask: {state['current_task']}
+""")
     response = llm.invoke([system_prompt] + messages)
     return {"messages": [response]}
 
-def tool_node(state: AgentState):
-    last_message = state['messages'][-1]
-    if not last_message.tool_calls:
+TOOL_DISPATCH = {t.name: t for t in tools}
+# Raw functions and their signatures, so well-formed calls skip Tool.invoke's pydantic layer
+TOOL_FUNCS = {t.name: t.func for t in tools}
+TOOL_SIGNATURES = {name: inspect.signature(func) for name, func in TOOL_FUNCS.items()}
+
+# Shared pool for running independent tool calls from one LLM turn concurrently
+tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_CONCURRENCY_LIMIT", "4")))
+
+def run_tool_call(tool_call: dict):
+    """Run a single tool call and return a plain result dict (no shared state is touched)."""
+    name, args = tool_call['name'], tool_call['args']
+    if name not in TOOL_FUNCS:
+        res = tool_error("Unknown tool")
+    else:
+        try:
+            TOOL_SIGNATURES[name].bind(**args)
+        except TypeError:
+            # Args don't match the signature; let the tool schema coerce/validate them
+            res = TOOL_DISPATCH[name].invoke(args)
+        else:
+            res = TOOL_FUNCS[name](**args)
+    if not isinstance(res, dict):
+        res = tool_ok(str(res))
+    return {"tool_call_id": tool_call['id'], "ok": res["ok"], "output": str(res["output"])}
+
+def run_search_batch(tool_calls: List[dict]):
+    """Run several search_codebase calls as one batched RAG query per language filter."""
+    groups = {}
+    for tc in tool_calls:
+        groups.setdefault(tc['args'].get('language'), []).append(tc)
+    results = []
+    for language, group in groups.items():
+        outputs = cached_search([tc['args']['query'] for tc in group], language)
+        results.extend(
+            {"tool_call_id": tc['id'], **search_result(out)}
+            for tc, out in zip(group, outputs)
+        )
+    return results
+
+def is_search_call(tool_call: dict):
+    return tool_call['name'] == "search_codebase" and isinstance(tool_call['args'].get('query'), str)
+
+async def tool_node(state: AgentState):
+    # Parallel executor branches each append their own AIMessage at the tail
+    pending = []
+    for message in reversed(state['messages']):
+        if not isinstance(message, AIMessage):
+            break
+        pending.insert(0, message)
+    
+    tool_calls = [tc for message in pending for tc in message.tool_calls]
+    if not tool_calls:
         return {} # Should not happen if routed correctly
     
-    results = []
-    for tool_call in last_message.tool_calls:
-        tool_name = tool_call['name']
-        tool_args = tool_call['args']
-        
-        if tool_name == "search_codebase":
-            res = search_codebase.invoke(tool_args)
-        elif tool_name == "run_shell":
-            res = run_shell.invoke(tool_args)
-        elif tool_name == "write_file":
-            res = write_file.invoke(tool_args)
-        elif tool_name == "read_file":
-            res = read_file.invoke(tool_args)
-        elif tool_name == "list_files":
-            res = list_files.invoke(tool_args)
-        else:
-            res = "Unknown tool"
-            
-        results.append(
-            {"tool_call_id": tool_call['id'], "output": str(res)}
+    updates = []
+    if len(pending) > 1:
+        # Fold the branch messages into one so every tool call is directly followed by its result
+        merged = AIMessage(
+            id=pending[0].id,
+            content="\n\n".join(m.content for m in pending if m.content),
+            tool_calls=tool_calls
         )
+        updates = [merged] + [RemoveMessage(id=m.id) for m in pending[1:]]
+    
+    # Blocking tool work runs on the shared pool so the graph's event loop stays free.
+    # Multiple searches in one turn are coalesced into a single batched RAG call.
+    loop = asyncio.get_running_loop()
+    searches = [tc for tc in tool_calls if is_search_call(tc)]
+    batch_searches = len(searches) > 1
+    futures = [
+        loop.run_in_executor(tool_executor, run_tool_call, tc)
+        for tc in tool_calls if not (batch_searches and is_search_call(tc))
+    ]
+    if batch_searches:
+        futures.append(loop.run_in_executor(tool_executor, run_search_batch, searches))
+    by_id = {}
+    for res in await asyncio.gather(*futures):
+        for item in (res if isinstance(res, list) else [res]):
+            by_id[item["tool_call_id"]] = item
+    # Keep results in tool_calls order
+    results = [by_id[tc['id']] for tc in tool_calls]
         
-    # Construct tool messages
+    # Construct tool messages; status carries the ok flag so consumers needn't scan the text
     tool_messages = []
     for res in results:
          tool_messages.append(
-             {"role": "tool", "tool_call_id": res["tool_call_id"], "content": res["output"]}
+             ToolMessage(
+                 content=res["output"],
+                 tool_call_id=res["tool_call_id"],
+                 status="success" if res["ok"] else "error"
+             )
          )
          
-    return {"messages": tool_messages, "last_tool_output": str(results)}
+    return {
+        "messages": updates + tool_messages,
+        "last_tool_ok": all(res["ok"] for res in results)
+    }
 
 def verifier_node(state: AgentState):
-    # Check if the last output was an error
-    last_output = state.get('last_tool_output', "")
-    if "Error" in last_output or "Exception" in last_output:
+    # Check if any tool in the last batch reported a failure
+    if not state.get('last_tool_ok', True):
         return {"error": "Last command failed. Fix it."}
     return {"error": ""}
 
@@ -253,6 +427,13 @@ def should_continue(state: AgentState):
         return "tools"
     return END
 
+def fan_out(state: AgentState):
+    plan = state.get('plan') or []
+    if len(plan) <= 1:
+        return "executor"
+    # One executor branch per independent subtask; add_messages merges their replies
+    return [Send("executor", {"messages": state["messages"], "current_task": task}) for task in plan]
+
 # --- Graph Definition ---
 workflow = StateGraph(AgentState)
 
@@ -262,7 +443,7 @@ workflow.add_node("tools", tool_node)
 workflow.add_node("verifier", verifier_node)
 
 workflow.set_entry_point("planner")
-workflow.add_edge("planner", "executor")
+workflow.add_conditional_edges("planner", fan_out, ["executor"])
 workflow.add_conditional_edges("executor", should_continue, {"tools": "tools", END: END})
 workflow.add_edge("tools", "verifier")
 workflow.add_edge("verifier", "executor") # Loop back to executor to continue (Plan-Act-Verify)
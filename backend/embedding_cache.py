@@ -0,0 +1,80 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """LRU + TTL cache of embedding vectors keyed by SHA-256 of the input text."""
+
+    def __init__(self, max_size=2000, ttl=24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # sha256 digest -> (created_at, vector)
+
+    @staticmethod
+    def _key(text: str):
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _get(self, key):
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                created_at, vector = hit
+                if time.time() - created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    return vector
+                del self._entries[key]
+        return None
+
+    def _put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = (time.time(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return vector
+
+    def get_or_embed(self, text: str, embed_fn):
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            # Embed outside the lock so concurrent misses don't serialize on the API call
+            vector = self._put(key, embed_fn(text))
+        return vector
+
+    def get_or_embed_many(self, texts, embed_many_fn):
+        """Like get_or_embed, but all misses go to the embedder in one batch call."""
+        keys = [self._key(t) for t in texts]
+        vectors = [self._get(k) for k in keys]
+        missing = {}
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            batch = [texts[idxs[0]] for idxs in missing.values()]
+            for (key, idxs), vector in zip(missing.items(), embed_many_fn(batch)):
+                vector = self._put(key, vector)
+                for i in idxs:
+                    vectors[i] = vector
+        return vectors
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by the FastAPI process and the agent
+embedding_cache = EmbeddingCache()
+
+def embed_with_cache(text: str, embed_fn):
+    """Return the embedding for text, calling embed_fn only on a cache miss."""
+    return embedding_cache.get_or_embed(text, embed_fn)
+
+def embed_many_with_cache(texts, embed_many_fn):
+    """Return embeddings for texts, batching every cache miss into one embed_many_fn call."""
+    return embedding_cache.get_or_embed_many(texts, embed_many_fn)
@@ -0,0 +1,15 @@
+import os
+
+def write_text(path: str, text: str):
+    """
+    Write text to path as UTF-8 with raw os.open/os.write.
+    Skips the TextIOWrapper/buffer layers of open(path, "w"); loops because
+    os.write may write fewer bytes than asked.
+    """
+    data = memoryview(text.encode("utf-8"))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
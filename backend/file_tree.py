@@ -0,0 +1,80 @@
+import os
+import threading
+
+# Cached directory listings: dir path -> (st_mtime_ns, nodes, subdir nodes to descend into)
+TREE_CACHE = {}
+# Tree builds and invalidations run on different request threads
+_cache_lock = threading.Lock()
+
+def _ignored(name: str):
+    return (name.startswith('.') or 
+            name == '__pycache__' or 
+            'node_modules' in name or
+            name == 'qdrant_data')
+
+def _sort_key(node):
+    return node["name"].lower()
+
+def invalidate_tree(path: str):
+    """Drop cached listings affected by creating/deleting/writing path."""
+    prefix = path.rstrip(os.sep) + os.sep
+    with _cache_lock:
+        TREE_CACHE.pop(os.path.dirname(path), None)
+        for cached_path in [p for p in TREE_CACHE if p == path or p.startswith(prefix)]:
+            del TREE_CACHE[cached_path]
+
+def _list_dir(path: str):
+    """Return (nodes, subdirs) for one directory, re-scanning only if its mtime changed."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        with _cache_lock:
+            TREE_CACHE.pop(path, None)
+        return [], []
+
+    with _cache_lock:
+        cached = TREE_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    folders, files, subdirs = [], [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # Prune before touching the entry, like os.walk's dirnames[:] filter
+                if _ignored(entry.name):
+                    continue
+                node = {"id": entry.path, "name": entry.name}
+                if entry.is_dir():
+                    node["type"] = "folder"
+                    node["children"] = []
+                    folders.append(node)
+                    # Don't follow symlinked dirs (followlinks=False), so link cycles can't loop
+                    if not entry.is_symlink():
+                        subdirs.append(node)
+                else:
+                    node["type"] = "file"
+                    files.append(node)
+    except PermissionError:
+        pass
+
+    folders.sort(key=_sort_key)
+    files.sort(key=_sort_key)
+    nodes = folders + files
+    with _cache_lock:
+        TREE_CACHE[path] = (mtime, nodes, subdirs)
+    return nodes, subdirs
+
+def get_file_tree(path: str):
+    """
+    Build the nested file tree iteratively (folders first, then files).
+    Each directory is only re-scanned when its mtime changed; unchanged
+    directories reuse their cached listing and just revalidate subfolders.
+    """
+    tree, subdirs = _list_dir(path)
+    stack = list(subdirs)
+    while stack:
+        node = stack.pop()
+        node["children"], subdirs = _list_dir(node["id"])
+        stack.extend(subdirs)
+    return tree
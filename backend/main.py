@@ -3,38 +3,105 @@ load_dotenv()
 
 from fastapi import FastAPI, Request, Form, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, FileResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
-from agent_graph import app as agent_app, set_active_project
-from vector_store import rag_engine
+from agent_graph import workflow, set_active_project, search_cache
+from file_tree import get_file_tree, invalidate_tree
+from shell_pool import shell_pool
+from file_io import write_text
 
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+import aiosqlite
 import json
 import asyncio
 import os
-import subprocess
+import threading
+import uuid
+from collections import deque
 import signal
 import markdown
 
 # Helper to render markdown for the frontend (Zero-JS)
+MD_EXTENSIONS = ['fenced_code', 'codehilite', 'tables', 'nl2br']
+# Markdown instances aren't thread-safe, so each thread builds its renderer once and reuses it
+_md_local = threading.local()
+
+def render_markdown(text):
+    try:
+        renderer = getattr(_md_local, "renderer", None)
+        if renderer is None:
+            renderer = _md_local.renderer = markdown.Markdown(extensions=MD_EXTENSIONS)
+        # Convert Markdown to HTML
+        renderer.reset()
+        return renderer.convert(text)
+    except Exception:
+        return text # Fallback to raw text
+
 def process_chat_history(history):
+    # Agent messages are immutable once written, so their HTML is rendered once and kept in "_html"
     processed = []
     for msg in history:
-        new_msg = msg.copy()
         if msg["role"] == "Agent":
-            try:
-                # Convert Markdown to HTML
-                new_msg["content"] = markdown.markdown(
-                    msg["content"], 
-                    extensions=['fenced_code', 'codehilite', 'tables', 'nl2br']
-                )
-            except Exception:
-                pass # Fallback to raw text
-        processed.append(new_msg)
+            if "_html" not in msg:
+                msg["_html"] = render_markdown(msg["content"])
+            processed.append({"role": msg["role"], "content": msg["_html"]})
+        else:
+            processed.append(msg)
     return processed
 
+# Blocking file helpers; handlers run them via asyncio.to_thread to keep the event loop free
+# Files bigger than this aren't inlined into the editor page; they're served by /file/raw
+MAX_INLINE_BYTES = 256 * 1024
+
+# /editor/run output is read in chunks of this size; longer unterminated lines are split
+OUTPUT_READ_SIZE = 64 * 1024
+MAX_TERMINAL_LINE = 64 * 1024
+# Interpreter /editor/run starts for each file extension
+RUNNERS = {".py": "python3", ".js": "node", ".sh": "bash"}
+
+def _read_text_inline(path):
+    """Read a file for the editor, or return None if it's too large to inline."""
+    with open(path, "r", encoding="utf-8") as f:
+        if os.fstat(f.fileno()).st_size > MAX_INLINE_BYTES:
+            return None
+        return f.read()
+
 app = FastAPI(title="CodePilot AI Backend (Zero JS)")
 
+# Compiled on startup: the sqlite checkpointer has to be created inside the running loop
+agent_app = None
+checkpointer = None
+
+@app.on_event("startup")
+async def startup():
+    global agent_app, checkpointer
+    checkpointer = AsyncSqliteSaver(aiosqlite.connect(os.path.join(BACKEND_DIR, "agent_state.db")))
+    agent_app = workflow.compile(checkpointer=checkpointer)
+    # Thread ids only live as long as the process, so earlier runs' rows are unreachable
+    await delete_thread_rows()
+
+async def delete_thread_rows(thread_id=None):
+    """Delete one thread's checkpoints (every thread if None); the saver has no delete_thread itself."""
+    if not checkpointer:
+        return
+    await checkpointer.setup()
+    where, params = ("WHERE thread_id = ?", (thread_id,)) if thread_id else ("", ())
+    async with checkpointer.lock:
+        for table in ("checkpoints", "writes"):
+            await checkpointer.conn.execute(f"DELETE FROM {table} {where}", params)
+        await checkpointer.conn.commit()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Keep the semantic search cache across reloads
+    search_cache.save()
+    shell_pool.close()
+    if state.agent_task:
+        state.agent_task.cancel()
+    if checkpointer:
+        await checkpointer.conn.close()
+
 # Determine backend directory
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 # Determine project root (parent of backend directory)
@@ -49,13 +116,59 @@ templates = Jinja2Templates(directory=os.path.join(BACKEND_DIR, "templates"))
 # --- State (Simple In-Memory for Zero JS Demo) ---
 # In a real app, use a proper session/db.
 class GlobalState:
-    terminal_history = "Welcome to CodePilot Terminal.\n"
+    # Bounded line buffer: O(1) appends, oldest output drops off once full
+    terminal_history = deque(["Welcome to CodePilot Terminal."], maxlen=5000)
     chat_history = []
+    lc_messages = [] # LangChain messages kept in step with chat_history
+    thread_id = uuid.uuid4().hex # Checkpointer thread holding the agent's state for this chat
+    agent_cursor = 0 # lc_messages before this index are already in the checkpointed thread
     open_files = [] # List of full paths
-    running_process = None # Subprocess object
+    running_process = None # asyncio subprocess started by /editor/run
+    output_task = None # Task streaming running_process output
+    stop_requested = False # /editor/stop already sent SIGTERM to running_process
     current_working_dir = PROJECT_ROOT
+    pending_chat = False # A user message is waiting for the agent worker
+    agent_running = False
+    agent_task = None # Background task running queued chat turns
     
 state = GlobalState()
+chat_lock = threading.Lock()
+
+# Chat roles map onto the message types fed back to the agent
+LC_MESSAGE_TYPES = {
+    "User": HumanMessage,
+    "Agent": AIMessage,
+    "System": SystemMessage, # Tool outputs/logs go back to the agent as context
+}
+
+def append_chat(role, content, **extra):
+    """Append to chat_history and its LangChain mirror together."""
+    entry = {"role": role, "content": content, **extra}
+    with chat_lock:
+        state.chat_history.append(entry)
+        state.lc_messages.append(LC_MESSAGE_TYPES[role](content=content))
+    return entry
+
+# Set (then replaced) whenever chat_history grows or a run ends, to wake /chat/stream tails
+_chat_event = asyncio.Event()
+
+def notify_chat():
+    global _chat_event
+    event, _chat_event = _chat_event, asyncio.Event()
+    event.set()
+
+# Keeps pending thread cleanups referenced until they finish
+_cleanup_tasks = set()
+
+def reset_agent_thread():
+    """Start a fresh checkpointer thread; the next run replays the whole chat."""
+    old_thread_id = state.thread_id
+    state.thread_id = uuid.uuid4().hex
+    state.agent_cursor = 0
+    # Nothing reads the abandoned thread again, so drop its rows
+    task = asyncio.get_running_loop().create_task(delete_thread_rows(old_thread_id))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
 
 @app.get("/", response_class=HTMLResponse)
 async def get_workspace(
@@ -69,7 +182,8 @@ async def get_workspace(
     cwd: str = None # Legacy: state.cwd is used
 ):
     """Serve the main workspace UI."""
-    current_tree = get_file_tree(PROJECT_ROOT)
+    active_file_too_large = False
+    current_tree = await asyncio.to_thread(get_file_tree, PROJECT_ROOT)
     
     # Handle Tabs
     if close_file and close_file in state.open_files:
@@ -80,16 +194,21 @@ async def get_workspace(
     
     if file:
         full_path = file
-        if full_path.startswith(PROJECT_ROOT) and os.path.exists(full_path) and os.path.isfile(full_path):
-             if full_path not in state.open_files:
-                 state.open_files.append(full_path)
-             active_file = os.path.basename(full_path)
-             with open(full_path, "r", encoding="utf-8") as f:
-                 active_file_content = f.read()
-        else:
-            # Invalid file or directory
-             active_file = None
-             active_file_content = ""
+        active_file = None
+        active_file_content = ""
+        if full_path.startswith(PROJECT_ROOT):
+            # Open directly and let the error tell us if it's missing or a directory
+            try:
+                active_file_content = await asyncio.to_thread(_read_text_inline, full_path)
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                pass # Invalid file or directory
+            else:
+                if full_path not in state.open_files:
+                    state.open_files.append(full_path)
+                active_file = os.path.basename(full_path)
+                if active_file_content is None:
+                    active_file_too_large = True
+                    active_file_content = ""
     else:
         # If no file requested, default to last open
         if state.open_files:
@@ -105,14 +224,19 @@ async def get_workspace(
         "active_file": active_file,
         "active_file_path": file,
         "active_file_content": active_file_content,
-        "terminal_output": state.terminal_history,
+        "active_file_too_large": active_file_too_large,
+        "max_inline_kb": MAX_INLINE_BYTES // 1024,
+        "terminal_output": "\n".join(state.terminal_history),
         "chat_history": process_chat_history(state.chat_history),
+        "agent_pending": state.pending_chat or state.agent_running,
+        "chat_cursor": len(state.chat_history),
         "parent_path": create_path if create_path else os.path.dirname(PROJECT_ROOT),
         "current_path": PROJECT_ROOT,
         "open_files": state.open_files,
         "new_item_path": new_item_path,
         "delete_path": delete_path,
         "cwd": state.current_working_dir,
+        "process_running": state.running_process is not None,
         "os": os # passing os for basename in template
     })
 
@@ -131,19 +255,20 @@ async def create_item_form(
              pass
 
         if type == "folder":
-            os.makedirs(full_path, exist_ok=True)
+            await asyncio.to_thread(os.makedirs, full_path, exist_ok=True)
+            invalidate_tree(full_path)
             # Stay on page
             return RedirectResponse(url="/", status_code=303)
         else:
             # File
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            with open(full_path, "w", encoding="utf-8") as f:
-                f.write("") # Create empty file
+            await asyncio.to_thread(os.makedirs, os.path.dirname(full_path), exist_ok=True)
+            await asyncio.to_thread(write_text, full_path, "") # Create empty file
+            invalidate_tree(full_path)
             # Open the new file
             return RedirectResponse(url=f"/?file={full_path}", status_code=303)
             
     except Exception as e:
-        state.terminal_history += f"Error creating item: {e}\n"
+        state.terminal_history.append(f"Error creating item: {e}")
         return RedirectResponse(url="/", status_code=303)
 
 @app.post("/item/delete")
@@ -152,19 +277,20 @@ async def delete_item_form(path: str = Form(...)):
     try:
         # Security check
         if not path.startswith(PROJECT_ROOT):
-             state.terminal_history += "Error: Cannot delete outside project root.\n"
+             state.terminal_history.append("Error: Cannot delete outside project root.")
              return RedirectResponse(url="/", status_code=303)
              
         if os.path.isdir(path):
-            shutil.rmtree(path)
+            await asyncio.to_thread(shutil.rmtree, path)
         elif os.path.isfile(path):
-            os.remove(path)
+            await asyncio.to_thread(os.remove, path)
             # Close file if open
             if path in state.open_files:
                 state.open_files.remove(path)
+        invalidate_tree(path)
                 
     except Exception as e:
-        state.terminal_history += f"Error deleting item: {e}\n"
+        state.terminal_history.append(f"Error deleting item: {e}")
         
     return RedirectResponse(url="/", status_code=303)
 
@@ -172,12 +298,20 @@ async def delete_item_form(path: str = Form(...)):
 @app.post("/file/save")
 async def save_file(path: str = Form(...), content: str = Form(...)):
     if path and path.startswith(PROJECT_ROOT):
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content.replace('\r\n', '\n')) # Normalize encoded newlines
+        await asyncio.to_thread(write_text, path, content.replace('\r\n', '\n')) # Normalize encoded newlines
+        invalidate_tree(path)
     
     # Redirect back to the file
     return RedirectResponse(url=f"/?file={path}", status_code=303)
 
+@app.get("/file/raw")
+async def raw_file(path: str):
+    """Serve a project file as-is (used for files too large to inline in the editor)."""
+    real_path = os.path.realpath(path)
+    if not real_path.startswith(os.path.realpath(PROJECT_ROOT) + os.sep) or not os.path.isfile(real_path):
+        return PlainTextResponse("File not found.", status_code=404)
+    return FileResponse(real_path)
+
 @app.post("/terminal/exec")
 async def shell_exec(command: str = Form(...), current_path: str = Form(None)):
     if not command:
@@ -189,131 +323,166 @@ async def shell_exec(command: str = Form(...), current_path: str = Form(None)):
         new_path = os.path.normpath(os.path.join(state.current_working_dir, target))
         if os.path.exists(new_path) and os.path.isdir(new_path):
             state.current_working_dir = new_path
-            state.terminal_history += f"{state.current_working_dir} $ {command}\n"
+            state.terminal_history.append(f"{state.current_working_dir} $ {command}")
         else:
-            state.terminal_history += f"{state.current_working_dir} $ {command}\nError: Directory not found\n"
+            state.terminal_history.extend([f"{state.current_working_dir} $ {command}", "Error: Directory not found"])
         return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
 
     # Handle Clear
     if command.strip() == "clear":
-        state.terminal_history = ""
+        state.terminal_history.clear()
         return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
 
-    # Execute synchronously
-    state.terminal_history += f"{state.current_working_dir} $ {command}\n"
+    # Execute on a pooled shell (off the event loop)
+    state.terminal_history.append(f"{state.current_working_dir} $ {command}")
     
     try:
-        res = subprocess.run(
-            command,
-            cwd=state.current_working_dir,
-            shell=True,
-            capture_output=True,
-            text=True
-        )
-        output = res.stdout + res.stderr
-        state.terminal_history += output + "\n"
+        _, output = await asyncio.to_thread(shell_pool.run, command, state.current_working_dir)
+        state.terminal_history.extend(output.splitlines())
     except Exception as e:
-        state.terminal_history += f"Error: {e}\n"
+        state.terminal_history.append(f"Error: {e}")
 
     return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
 
+def _terminal_line(raw: bytes):
+    return raw.decode("utf-8", errors="replace").rstrip("\r")
+
+async def stream_process_output(proc):
+    """Append a running process's output to the terminal line by line."""
+    # Read fixed-size chunks and split lines here: readline() raises on lines over
+    # the StreamReader limit, and a single huge line shouldn't end the stream
+    pending = b""
+    flushed = False # pending was cut off mid-line and already shown
+    try:
+        while True:
+            chunk = await proc.stdout.read(OUTPUT_READ_SIZE)
+            if not chunk:
+                break
+            *lines, pending = (pending + chunk).split(b"\n")
+            if flushed and lines:
+                # The newline ending a cut-off line shouldn't show up as an empty line
+                if not lines[0]:
+                    lines.pop(0)
+                flushed = False
+            state.terminal_history.extend(_terminal_line(line) for line in lines)
+            # Cap an unterminated line so it can't grow without bound
+            if len(pending) > MAX_TERMINAL_LINE:
+                state.terminal_history.append(_terminal_line(pending))
+                pending = b""
+                flushed = True
+        if pending:
+            state.terminal_history.append(_terminal_line(pending))
+    except Exception as e:
+        state.terminal_history.append(f"Error execution: {e}")
+    finally:
+        # Keep the handle until the child has exited, so /editor/stop can still reach it
+        try:
+            await proc.wait()
+            state.terminal_history.append(f"[Process finished with exit code {proc.returncode}]")
+        finally:
+            if state.running_process is proc:
+                state.running_process = None
+
 @app.post("/editor/run")
 async def run_code(current_path: str = Form(...)):
-    if not current_path or not os.path.exists(current_path):
-         state.terminal_history += "Error: No file selected to run.\n"
+    # A missing file is reported by the runner itself in the terminal output
+    if not current_path:
+         state.terminal_history.append("Error: No file selected to run.")
          return RedirectResponse(url="/", status_code=303)
 
     # Simple extension detection
     ext = os.path.splitext(current_path)[1].lower()
-    cmd = None
-    if ext == ".py":
-        cmd = f"python3 {current_path}"
-    elif ext == ".js":
-        cmd = f"node {current_path}"
-    elif ext == ".sh":
-        cmd = f"bash {current_path}"
-    else:
-        state.terminal_history += f"Error: No runner configured for {ext}\n"
+    runner = RUNNERS.get(ext)
+    if runner is None:
+        state.terminal_history.append(f"Error: No runner configured for {ext}")
         return RedirectResponse(url=f"/?file={current_path}", status_code=303)
         
-    state.terminal_history += f"$ {cmd}\n"
+    cmd = f"{runner} {current_path}"
+    state.terminal_history.append(f"$ {cmd}")
     
-    # Run in background (but we want output)
-    # For Zero-JS sync MVP, we'll run blocking but with timeout? 
-    # Or start a background thread that appends to history?
-    # Let's do partial blocking for immediate feedback, or simple subprocess run.
-    
-    def run_proc():
-        try:
-            state.running_process = subprocess.Popen(
-                cmd, 
-                shell=True, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE, 
-                text=True,
-                cwd=PROJECT_ROOT
-            )
-            stdout, stderr = state.running_process.communicate()
-            state.terminal_history += stdout + stderr + "\n"
-            state.terminal_history += f"[Process finished with exit code {state.running_process.returncode}]\n"
-            state.running_process = None
-        except Exception as e:
-            state.terminal_history += f"Error execution: {e}\n"
-            
-    # Run in thread so we don't block the server entirely (though python GIL...)
-    # Actually, for "Zero JS", blocking the *response* until it's done is bad if it's long.
-    # But if it's short, it's fine. 
-    # Users asked for "Reset/Stop".
-    # Let's spawn a thread.
-    import threading
-    t = threading.Thread(target=run_proc)
-    t.start()
-    
-    # Brief wait to catch immediate errors
-    t.join(timeout=0.5) 
+    # Output is streamed into terminal_history by a background task, so the
+    # response returns immediately and each page load shows live progress.
+    try:
+        # exec rather than a shell, so the path isn't interpolated and the
+        # child itself (not a /bin/sh wrapper) leads its own process group
+        proc = await asyncio.create_subprocess_exec(
+            runner, current_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            cwd=PROJECT_ROOT,
+            start_new_session=True
+        )
+    except Exception as e:
+        state.terminal_history.append(f"Error execution: {e}")
+        return RedirectResponse(url=f"/?file={current_path}", status_code=303)
+
+    state.running_process = proc
+    state.stop_requested = False
+    state.output_task = asyncio.create_task(stream_process_output(proc))
     
     return RedirectResponse(url=f"/?file={current_path}", status_code=303)
 
 @app.post("/editor/stop")
 async def stop_code(current_path: str = Form(None)):
     if state.running_process:
-        state.running_process.terminate()
-        state.running_process = None
-        state.terminal_history += "^C [Process terminated by user]\n"
+        # Signal the whole group so programs the script spawned stop too. A
+        # second stop escalates to SIGKILL for processes that ignore SIGTERM.
+        # The output task records the exit code and clears running_process once it exits
+        sig = signal.SIGKILL if state.stop_requested else signal.SIGTERM
+        state.stop_requested = True
+        try:
+            os.killpg(state.running_process.pid, sig)
+        except ProcessLookupError:
+            pass # Exited already; the output task is finishing up
+        state.terminal_history.append("^C [Process terminated by user]")
     else:
-        state.terminal_history += "No running process to stop.\n"
+        state.terminal_history.append("No running process to stop.")
         
     return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
 
 @app.post("/chat/clear")
 async def clear_chat(current_path: str = Form(None)):
-    state.chat_history = []
+    if state.agent_task:
+        # The run belongs to the chat being cleared
+        state.pending_chat = False
+        state.agent_task.cancel()
+    with chat_lock:
+        state.chat_history = []
+        state.lc_messages = []
+        reset_agent_thread()
     # Re-initialize with a welcome output if desired, or empty.
     return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
 
 @app.post("/chat")
 async def chat_post(message: str = Form(...), current_path: str = Form(None)):
-    state.chat_history.append({"role": "User", "content": message})
-    
+    append_chat("User", message)
+    # Runs in the background, so reloads and other form posts don't interrupt it
+    state.pending_chat = True
+    start_agent()
+    return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
+
+async def run_agent():
+    """Run the agent over the chat history, yielding each chat entry as it is appended."""
+    completed = False
     try:
-        # Construct messages properly
-        history_objs = []
-        for msg in state.chat_history:
-            if msg["role"] == "User":
-                history_objs.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "Agent":
-                history_objs.append(AIMessage(content=msg["content"]))
-            elif msg["role"] == "System":
-                # Feed tool outputs/logs back to the agent as SystemMessages for context
-                history_objs.append(SystemMessage(content=msg["content"]))
+        # The checkpointer already holds earlier turns, so only send what's new.
+        # A fresh thread gets the full history; later turns just the new user messages.
+        with chat_lock:
+            if state.agent_cursor == 0:
+                history_objs = list(state.lc_messages)
+            else:
+                history_objs = [m for m in state.lc_messages[state.agent_cursor:] if isinstance(m, HumanMessage)]
+            state.agent_cursor = len(state.lc_messages)
             
         print(f"Invoking agent with {len(history_objs)} messages...")
         
         inputs = {"messages": history_objs}
-        final_text = ""
+        # Parallel subtasks each finish with their own answer; keep them all (by id, in order)
+        final_answers = {}
         
         if agent_app:
-            async for event in agent_app.astream(inputs, config={"configurable": {"thread_id": "root"}}):
+            config = {"configurable": {"thread_id": state.thread_id}}
+            async for event in agent_app.astream(inputs, config=config):
                 for node_name, node_state in event.items():
                     # Capture Tool Calls
                     messages = node_state.get("messages", [])
@@ -341,37 +510,90 @@ async def chat_post(message: str = Form(...), current_path: str = Form(None)):
                                 elif name == "search_codebase":
                                     log_content = f"Searching codebase for: '{args.get('query')}'"
                                     
-                                state.chat_history.append({"role": "System", "content": log_content})
+                                yield append_chat("System", log_content)
                         
                         # Tool Output Log
                         if isinstance(messages, list):
                             for m in messages:
-                                if hasattr(m, 'role') and m.role == 'tool':
+                                if isinstance(m, ToolMessage):
                                     # We can hide tool outputs or show them compactly
                                     # User wants "Professional", often implies hiding raw return values unless error
                                     content = str(m.content)
-                                    if "Error" in content or "Exception" in content:
-                                        state.chat_history.append({"role": "System", "content": f"⚠️ Tool Error: {content}"})
+                                    if m.status == "error":
+                                        yield append_chat("System", f"⚠️ Tool Error: {content}")
                                     else:
                                         # Success indication
-                                        state.chat_history.append({"role": "System", "content": "✓ Action completed successfully."})
+                                        yield append_chat("System", "✓ Action completed successfully.")
                                     
                         # Final response
                         if isinstance(last_msg, AIMessage) and not last_msg.tool_calls and last_msg.content:
-                            final_text = last_msg.content
+                            final_answers[last_msg.id] = last_msg.content
                             
+            if len(final_answers) > 1:
+                # Branch events arrive in completion order; show answers in conversation order
+                snapshot = await agent_app.aget_state(config)
+                position = {m.id: i for i, m in enumerate(snapshot.values.get("messages", []))}
+                final_answers = dict(sorted(final_answers.items(), key=lambda item: position.get(item[0], len(position))))
+            final_text = "\n\n".join(final_answers.values())
         else:
             final_text = "Agent unavailable."
 
         if final_text:
-            state.chat_history.append({"role": "Agent", "content": final_text})
+            yield append_chat("Agent", final_text, _html=render_markdown(final_text))
         
     except Exception as e:
-        state.chat_history.append({"role": "System", "content": f"Error: {e}"})
+        yield append_chat("System", f"Error: {e}")
         import traceback
         traceback.print_exc()
+    else:
+        completed = True
+    finally:
+        # An interrupted run can leave unanswered tool calls in the checkpoint
+        if not completed:
+            reset_agent_thread()
 
-    return RedirectResponse(url=f"/?file={current_path}" if current_path else "/", status_code=303)
+async def agent_worker():
+    """Run queued chat turns until none are left; run_agent appends their entries to the chat."""
+    try:
+        while state.pending_chat:
+            state.pending_chat = False
+            async for _ in run_agent():
+                notify_chat()
+    finally:
+        state.agent_running = False
+        state.agent_task = None
+        notify_chat()
+
+def start_agent():
+    """Start the agent worker unless one is already running (it picks up pending turns itself)."""
+    if not state.agent_running:
+        state.agent_running = True
+        state.agent_task = asyncio.create_task(agent_worker())
+
+@app.get("/chat/stream")
+async def chat_stream(request: Request, after: int = 0):
+    """Server-Sent Events tail of the chat entries after index `after`, until the agent goes idle."""
+    async def event_gen():
+        cursor = after
+        while True:
+            # Grab the event before reading, so an append in between still wakes us
+            changed = _chat_event
+            with chat_lock:
+                entries = state.chat_history[cursor:]
+            cursor += len(entries)
+            for entry in entries:
+                yield f"data: {json.dumps({'role': entry['role'], 'content': entry.get('_html', entry['content'])})}\n\n"
+            if not state.agent_running:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+            if await request.is_disconnected():
+                break # Only the tail stops; the run carries on
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(event_gen(), media_type="text/event-stream")
 
 # --- Project Management ---
 @app.post("/project/create")
@@ -395,36 +617,6 @@ async def open_project(path: str = Form(...)):
     return RedirectResponse(url="/", status_code=303)
 
 
-# --- Helper ---
-def get_file_tree(path: str):
-    """
-    Build file tree recursive.
-    """
-    tree = []
-    try:
-        entries = sorted(os.scandir(path), key=lambda e: (not e.is_dir(), e.name.lower()))
-        for entry in entries:
-            if (entry.name.startswith('.') or 
-                entry.name == '__pycache__' or 
-                'node_modules' in entry.name or
-                entry.name == 'qdrant_data'):
-                continue
-                
-            node = {
-                "id": entry.path,
-                "name": entry.name,
-                "type": "folder" if entry.is_dir() else "file"
-            }
-            
-            if entry.is_dir():
-                node["children"] = get_file_tree(entry.path)
-            
-            tree.append(node)
-    except PermissionError:
-        pass
-        
-    return tree
-
 @app.get("/picker", response_class=HTMLResponse)
 async def file_picker(request: Request, path: str = None, mode: str = "open"):
     """Serve the No-JS file picker."""
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    Cache search results by query meaning instead of exact text.
+    Query embeddings are bucketed with random-projection LSH so only a few
+    candidates need a cosine check; exact repeats skip embedding entirely.
+    Entries are scoped by a namespace (e.g. the project searched), and only
+    match lookups in the same namespace.
+    """
+
+    def __init__(self, embed_fn, threshold=0.95, num_tables=4, num_bits=12,
+                 max_size=1000, ttl=3600, path=None, seed=42):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.seed = seed
+
+        self._lock = threading.Lock()
+        self._planes = None  # Created lazily once the embedding size is known
+        self._entries = OrderedDict()  # id -> {"namespace", "query", "vector", "results", "created_at"}
+        self._exact = {}  # (namespace, query text) -> id
+        self._buckets = [dict() for _ in range(num_tables)]  # signature -> set of ids
+        self._next_id = 0
+
+        if path:
+            self.load()
+
+    # --- LSH helpers ---
+    def _ensure_planes(self, dim: int):
+        if self._planes is None or self._planes.shape[2] != dim:
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal((self.num_tables, self.num_bits, dim)).astype(np.float32)
+
+    def _signatures(self, vector: np.ndarray):
+        self._ensure_planes(vector.shape[0])
+        bits = (self._planes @ vector) > 0
+        return [row.tobytes() for row in np.packbits(bits, axis=1)]
+
+    def _reset_on_dim_change(self, dim: int):
+        """Vectors from a different embedding size can't be compared; start over (caller holds the lock)."""
+        if self._planes is not None and self._planes.shape[2] != dim:
+            self._entries.clear()
+            self._exact.clear()
+            self._buckets = [dict() for _ in range(self.num_tables)]
+            self._planes = None
+
+    def _embed(self, query: str, vector=None):
+        """Normalized embedding of query; pass vector when the caller already embedded it."""
+        if vector is None:
+            vector = self.embed_fn(query)
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # --- Entry bookkeeping (caller holds the lock) ---
+    def _insert(self, entry_id, entry):
+        self._entries[entry_id] = entry
+        self._exact[(entry["namespace"], entry["query"])] = entry_id
+        for table, sig in zip(self._buckets, self._signatures(entry["vector"])):
+            table.setdefault(sig, set()).add(entry_id)
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        key = (entry["namespace"], entry["query"])
+        if self._exact.get(key) == entry_id:
+            del self._exact[key]
+        for table, sig in zip(self._buckets, self._signatures(entry["vector"])):
+            ids = table.get(sig)
+            if ids:
+                ids.discard(entry_id)
+                if not ids:
+                    del table[sig]
+
+    def _is_fresh(self, entry):
+        return time.time() - entry["created_at"] < self.ttl
+
+    # --- Public API ---
+    def lookup(self, query: str, namespace: str = "", vector=None):
+        """Return cached results for query (or a near-duplicate of it) in namespace, else None."""
+        with self._lock:
+            entry_id = self._exact.get((namespace, query))
+            if entry_id is not None:
+                entry = self._entries[entry_id]
+                if self._is_fresh(entry):
+                    self._entries.move_to_end(entry_id)
+                    return entry["results"]
+                self._drop(entry_id)
+
+        try:
+            vector = self._embed(query, vector)
+        except Exception as e:
+            log.warning("Semantic cache embed error: %s", e)
+            return None
+
+        with self._lock:
+            self._reset_on_dim_change(vector.shape[0])
+            candidates = set()
+            for table, sig in zip(self._buckets, self._signatures(vector)):
+                candidates |= table.get(sig, set())
+
+            best_id, best_sim = None, -1.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry["namespace"] != namespace or not self._is_fresh(entry):
+                    continue
+                sim = float(np.dot(vector, entry["vector"]))
+                if sim > best_sim:
+                    best_id, best_sim = entry_id, sim
+
+            if best_id is not None and best_sim >= self.threshold:
+                self._entries.move_to_end(best_id)
+                return self._entries[best_id]["results"]
+        return None
+
+    def store(self, query: str, results: str, namespace: str = "", vector=None):
+        try:
+            vector = self._embed(query, vector)
+        except Exception as e:
+            log.warning("Semantic cache embed error: %s", e)
+            return
+
+        with self._lock:
+            self._reset_on_dim_change(vector.shape[0])
+            old_id = self._exact.get((namespace, query))
+            if old_id is not None:
+                self._drop(old_id)
+            self._insert(self._next_id, {
+                "namespace": namespace,
+                "query": query,
+                "vector": vector,
+                "results": results,
+                "created_at": time.time()
+            })
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._exact.clear()
+            self._buckets = [dict() for _ in range(self.num_tables)]
+
+    # --- Persistence (JSON metadata + .npy vectors) ---
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = [e for e in self._entries.values() if self._is_fresh(e)]
+            if not entries:
+                # Don't let an older save resurrect entries that were cleared since
+                for suffix in (".json", ".npy"):
+                    try:
+                        os.remove(self.path + suffix)
+                    except FileNotFoundError:
+                        pass
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            np.save(self.path + ".npy", np.stack([e["vector"] for e in entries]))
+            with open(self.path + ".json", "w", encoding="utf-8") as f:
+                json.dump([
+                    {"namespace": e["namespace"], "query": e["query"],
+                     "results": e["results"], "created_at": e["created_at"]}
+                    for e in entries
+                ], f)
+
+    def load(self):
+        try:
+            with open(self.path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            vectors = np.load(self.path + ".npy")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.error("Semantic cache load error: %s", e)
+            return
+
+        with self._lock:
+            for item, vector in zip(meta, vectors):
+                entry = dict(item, vector=vector.astype(np.float32))
+                if self._is_fresh(entry):
+                    self._insert(self._next_id, entry)
+                    self._next_id += 1
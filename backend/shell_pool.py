@@ -0,0 +1,117 @@
+import os
+import uuid
+import queue
+import shlex
+import tempfile
+import threading
+import subprocess
+
+
+class ShellWorker:
+    """A long-lived bash process that runs one command at a time over stdin."""
+
+    def __init__(self):
+        self.token = f"__DONE_{uuid.uuid4().hex}__"
+        self.proc = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, command: str, cwd: str):
+        # Output goes to a file of its own rather than the shared stdout pipe, so
+        # jobs the command leaves in the background can't write into the next
+        # command's output or hold the pipe open; only the sentinel uses the pipe
+        fd, out_path = tempfile.mkstemp(prefix="codepilot-shell-")
+        os.close(fd)
+        try:
+            # Subshell keeps cd/export from leaking into later commands; stdin is detached
+            # so the command can't swallow the next one we write
+            script = (
+                f"( cd -- {shlex.quote(cwd)} && eval {shlex.quote(command)} ) "
+                f"< /dev/null > {shlex.quote(out_path)} 2>&1\n"
+                f"printf '{self.token} %s\\n' $?\n"
+            )
+            self.proc.stdin.write(script)
+            self.proc.stdin.flush()
+
+            line = self.proc.stdout.readline()
+            if not line.startswith(self.token):
+                raise RuntimeError("shell exited unexpectedly")
+            exit_code = int(line.split()[1])
+            with open(out_path, encoding="utf-8", errors="replace") as f:
+                return exit_code, f.read()
+        finally:
+            os.unlink(out_path)
+
+    def close(self):
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=1)
+        except Exception:
+            pass
+
+
+class ShellPool:
+    """
+    Fixed-size pool of warm shells.
+    Callers queue for an idle worker (FIFO); dead workers are replaced on acquire.
+    """
+
+    def __init__(self, size: int = 4):
+        self.size = size
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._spawned = 0
+        self._workers = []
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and self._spawned < self.size:
+                self._spawned += 1
+                worker = ShellWorker()
+                self._workers.append(worker)
+                return worker
+        worker = self._idle.get()
+        if not worker.alive():
+            worker = self._replace(worker)
+        return worker
+
+    def _replace(self, worker):
+        worker.close()
+        new_worker = ShellWorker()
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            self._workers.append(new_worker)
+        return new_worker
+
+    def run(self, command: str, cwd: str):
+        """Run command in cwd on a pooled shell; returns (exit_code, combined stdout/stderr)."""
+        worker = self._acquire()
+        try:
+            return worker.run(command, cwd)
+        except Exception:
+            worker = self._replace(worker)
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+            self._spawned = 0
+        self._idle = queue.Queue()
+
+
+shell_pool = ShellPool(size=int(os.getenv("SHELL_POOL_SIZE", "4")))
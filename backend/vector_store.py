@@ -1,94 +1,528 @@
 import os
+import uuid
+import hashlib
+import threading
+import asyncio
+import weakref
+import logging
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+import tiktoken
+from aiolimiter import AsyncLimiter
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
+from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Qdrant
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient, models
+from embedding_cache import embed_with_cache, embed_many_with_cache
+
+log = logging.getLogger(__name__)
+
+# Shortened 3-small vectors: a third of ada-002's bytes at a fraction of the cost
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIMENSIONS = 512
+# OpenAI accepts up to 2048 inputs per embeddings request
+EMBED_BATCH_SIZE = 2048
+# Embedding requests allowed in flight at once during ingestion
+EMBED_CONCURRENCY = 5
+# Tokens per embeddings request; OpenAI rejects requests over 300k
+EMBED_BATCH_TOKENS = 250_000
+# Account rate limits, enforced up front so ingestion doesn't burst into 429s
+EMBED_RPM = int(os.getenv("EMBED_RPM", "3500"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "350000"))
+# Points per upsert request, and upsert requests in flight at once
+UPSERT_BATCH_SIZE = 64
+UPSERT_CONCURRENCY = 3
+# Threads reading source files during ingestion
+READ_WORKERS = 32
+READ_BUFFER_SIZE = 1 << 16
+MIN_FILE_BYTES = 10
+MAX_FILE_BYTES = 1_000_000
+# Qdrant's default; HNSW building is switched off (0) while a bulk upload runs
+INDEXING_THRESHOLD = 20000
+
+# Points and queries go over gRPC: protobuf-packed floats instead of JSON arrays,
+# multiplexed on one persistent HTTP/2 connection
+QDRANT_HOST = "localhost"
+QDRANT_GRPC_PORT = 6334
+# Named by vector size, so a model change starts a fresh collection rather than
+# searching one whose vectors have a different dimension
+COLLECTION_NAME = f"codepilot_codebase_{EMBED_DIMENSIONS}"
+# On-disk chunk vectors, so re-ingesting only embeds chunks whose text changed
+CHUNK_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "chunk_embeddings")
+
+# Formatted search results kept per (query, repo, lang)
+RESULT_CACHE_SIZE = 256
+
+# Stored as metadata.language so searches can be narrowed server-side
+LANGUAGES = {
+    '.py': 'python', '.js': 'javascript', '.html': 'html', '.css': 'css',
+    '.md': 'markdown', '.txt': 'text', '.yml': 'yaml', '.json': 'json'
+}
+_EXTS = frozenset(LANGUAGES)
+_SKIP = frozenset(("__pycache__", "venv", "qdrant_data"))
+# Payload fields searches can filter on; indexed so Qdrant prunes during HNSW traversal
+FILTER_FIELDS = ("metadata.repo", "metadata.language", "metadata.filename_ext")
+
+# Stateless, so shared across ingests. Code splits on def/class/function and
+# markup on block tags/headings; other types use the generic separators.
+# Those boundaries stop definitions being packed together, so the language
+# splitters get larger chunks to keep the chunk count at or below the generic one
+_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+CODE_CHUNK_SIZE = 1200
+_SPLITTERS = {
+    ext: RecursiveCharacterTextSplitter.from_language(language, chunk_size=CODE_CHUNK_SIZE, chunk_overlap=100)
+    for ext, language in (
+        ('.py', Language.PYTHON), ('.js', Language.JS),
+        ('.html', Language.HTML), ('.md', Language.MARKDOWN)
+    )
+}
+
+# Callbacks run after an ingest changes the index, so caches built on search results can reset
+_index_listeners = []
+
+def on_index_change(listener):
+    _index_listeners.append(listener)
+
+def chunk_id(source: str, index: int):
+    """Stable point id, so re-ingesting a file overwrites its chunks instead of duplicating them."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source}#{index}"))
+
+def _skipped_dir(name: str):
+    """Same rule as file_tree._ignored, so ingest skips what the file tree hides."""
+    return name.startswith('.') or name in _SKIP or 'node_modules' in name
+
+def _collect_paths(path: str):
+    """Walk path with scandir, pruning skipped directories before descending into them."""
+    paths = []
+    stack = [path]
+    # Bound once; this loop runs for every entry in the tree
+    add_path, push, splitext = paths.append, stack.append, os.path.splitext
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    # DirEntry caches the d_type from readdir, so these checks don't stat
+                    if entry.is_dir(follow_symlinks=False):
+                        if not _skipped_dir(entry.name):
+                            push(entry.path)
+                    elif splitext(entry.name)[1] in _EXTS and entry.is_file():
+                        add_path(entry.path)
+        except OSError as e:
+            log.warning("Error scanning directory: %s", e)
+    return paths
+
+def _read_file(file_path: str):
+    """Return the file's text, or None if it's unreadable or outside the ingest size bounds."""
+    try:
+        with open(file_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            size = os.fstat(f.fileno()).st_size
+            # Skip empty/tiny files and large generated or data files
+            if size < MIN_FILE_BYTES or size > MAX_FILE_BYTES:
+                return None
+            return f.read().decode('utf-8', 'ignore')
+    except Exception as e:
+        log.warning("Error processing %s: %s", file_path, e)
+        return None
+
+def _encoding_for(model: str):
+    """tiktoken encoding for model, or None if its BPE file can't be loaded (e.g. offline)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        log.warning("Token counting falls back to an estimate: %s", e)
+        return None
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    Async calls are split into token-bounded requests, each waiting for request
+    and token capacity before reaching the API. Sits under the chunk cache, so
+    only cache misses are tokenized and throttled.
+    """
+
+    def __init__(self, embeddings: OpenAIEmbeddings):
+        self.embeddings = embeddings
+        self._encoding = None
+        self._encoding_loaded = False
+        # event loop -> (request limiter, token limiter)
+        self._loop_limiters = weakref.WeakKeyDictionary()
+
+    def count_tokens(self, texts):
+        if not self._encoding_loaded:
+            # Loaded on first use: tiktoken may have to download the BPE file
+            self._encoding = _encoding_for(self.embeddings.model)
+            self._encoding_loaded = True
+        if self._encoding is None:
+            # ~4 characters per token for English text and code
+            return [len(text) // 4 + 1 for text in texts]
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts)]
+
+    def _token_batches(self, texts):
+        """Split texts into (batch, tokens) requests bounded by input count and tokens."""
+        batches, batch, batch_tokens = [], [], 0
+        for text, tokens in zip(texts, self.count_tokens(texts)):
+            if batch and (len(batch) == EMBED_BATCH_SIZE or batch_tokens + tokens > EMBED_BATCH_TOKENS):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def _limiters(self):
+        # aiolimiter's waiters are futures bound to one loop, and ingest_codebase
+        # runs every ingest on a fresh loop, so each run gets its own budget.
+        # Runs that overlap in different threads each get the full rate
+        loop = asyncio.get_running_loop()
+        limiters = self._loop_limiters.get(loop)
+        if limiters is None:
+            limiters = self._loop_limiters[loop] = (AsyncLimiter(EMBED_RPM, 60), AsyncLimiter(EMBED_TPM, 60))
+        return limiters
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        request_limiter, token_limiter = self._limiters()
+        vectors = []
+        for batch, tokens in self._token_batches(texts):
+            # Cap at the bucket size; a single oversized request would never fit
+            await token_limiter.acquire(min(tokens, EMBED_TPM))
+            async with request_limiter:
+                vectors.extend(await self.embeddings.aembed_documents(batch))
+        return vectors
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
 
 class RAGEngine:
     def __init__(self):
-        print("DEBUG: Initializing RAGEngine...", flush=True)
+        log.debug("Initializing RAGEngine...")
+        # (query, repo, lang) -> formatted results; cleared whenever an ingest changes the index
+        self._results = OrderedDict()
+        self._results_lock = threading.Lock()
         try:
-            self.embeddings = OpenAIEmbeddings()
-            self.client = QdrantClient(url="http://localhost:6333")
-            self.collection_name = "codepilot_codebase"
+            self.embeddings = OpenAIEmbeddings(
+                model=EMBED_MODEL,
+                dimensions=EMBED_DIMENSIONS,
+                chunk_size=EMBED_BATCH_SIZE
+            )
+            self.limited_embeddings = RateLimitedEmbeddings(self.embeddings)
+            # Keyed by model/dimensions + chunk text hash; queries keep using the in-memory embedding cache
+            self.chunk_embeddings = CacheBackedEmbeddings.from_bytes_store(
+                self.limited_embeddings,
+                LocalFileStore(CHUNK_CACHE_DIR),
+                namespace=f"{EMBED_MODEL}-{EMBED_DIMENSIONS}"
+            )
+            self.client = QdrantClient(host=QDRANT_HOST, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=True)
+            self.collection_name = COLLECTION_NAME
             
             # Ensure collection exists
             collections = self.client.get_collections().collections
             if not any(c.name == self.collection_name for c in collections):
                 self.client.create_collection(
                     collection_name=self.collection_name,
-                    vectors_config=dict(size=1536, distance="Cosine")
+                    # Raw vectors live on disk; searches run on int8 copies kept in RAM (4x smaller)
+                    vectors_config=models.VectorParams(size=EMBED_DIMENSIONS, distance=models.Distance.COSINE, on_disk=True),
+                    quantization_config=models.ScalarQuantization(
+                        scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=True)
+                    ),
+                    # Stays off until the first ingest finishes and restores it
+                    optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0)
                 )
+                for field in FILTER_FIELDS:
+                    self.client.create_payload_index(
+                        collection_name=self.collection_name,
+                        field_name=field,
+                        field_schema=models.PayloadSchemaType.KEYWORD
+                    )
             
             self.vector_store = Qdrant(
                 client=self.client, 
                 collection_name=self.collection_name, 
                 embeddings=self.embeddings
             )
-            print("DEBUG: RAGEngine initialized successfully", flush=True)
+            log.debug("RAGEngine initialized successfully")
         except Exception as e:
-            print(f"RAG Engine Init Error: {e}")
+            log.error("RAG Engine Init Error: %s", e)
             self.embeddings = None
+            self.limited_embeddings = None
+            self.chunk_embeddings = None
             self.client = None
             self.vector_store = None
 
     def ingest_codebase(self, path: str):
+        """Blocking entry point for aingest_codebase (runs it on a fresh event loop)."""
+        asyncio.run(self.aingest_codebase(path))
+
+    def _set_indexing_threshold(self, threshold: int):
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=threshold)
+        )
+
+    async def _aembed_and_upsert(self, documents, repo):
+        """
+        Stream chunks through embedding and into Qdrant.
+        EMBED_CONCURRENCY workers embed batches of chunks and hand points to
+        UPSERT_CONCURRENCY upsert workers over a bounded queue, so uploads overlap
+        embedding instead of waiting for all of it. Identical chunks are embedded
+        once, and chunks already in the on-disk cache are not sent to the API.
+        The repo's existing points are deleted first, so chunks of files that
+        were removed or got shorter don't linger. Returns the number of points upserted.
+        """
+        # Generated files, license headers etc. repeat chunk text verbatim
+        by_hash = {}
+        unique_texts, doc_indexes = [], []
+        for i, doc in enumerate(documents):
+            h = hashlib.blake2b(doc.page_content.encode('utf-8'), digest_size=16).digest()
+            if h not in by_hash:
+                by_hash[h] = len(unique_texts)
+                unique_texts.append(doc.page_content)
+                doc_indexes.append([])
+            doc_indexes[by_hash[h]].append(i)
+
+        seen = {}
+        ids = []
+        for doc in documents:
+            source = doc.metadata["source"]
+            seen[source] = seen.get(source, -1) + 1
+            ids.append(chunk_id(source, seen[source]))
+
+        # Bounded so embedded-but-unsent points can't pile up in memory
+        in_q = asyncio.Queue(maxsize=2 * EMBED_CONCURRENCY)
+        out_q = asyncio.Queue(maxsize=2 * UPSERT_CONCURRENCY)
+        # Opened per run: ingest_codebase gives each run its own event loop, and
+        # its gRPC channel can't outlive the loop that opened it
+        aclient = AsyncQdrantClient(host=QDRANT_HOST, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=True)
+
+        async def produce():
+            # Cache hits are dropped below this, so token bounds are applied per request there
+            for start in range(0, len(unique_texts), EMBED_BATCH_SIZE):
+                await in_q.put(range(start, min(start + EMBED_BATCH_SIZE, len(unique_texts))))
+            for _ in range(EMBED_CONCURRENCY):
+                await in_q.put(None)
+
+        async def embed_worker():
+            while (batch := await in_q.get()) is not None:
+                vectors = await self.chunk_embeddings.aembed_documents([unique_texts[u] for u in batch])
+                points = [
+                    models.PointStruct(
+                        id=ids[i],
+                        vector=vector,
+                        # Same payload layout the langchain Qdrant store reads back in search()
+                        payload={"page_content": documents[i].page_content, "metadata": documents[i].metadata}
+                    )
+                    for u, vector in zip(batch, vectors)
+                    for i in doc_indexes[u]
+                ]
+                for start in range(0, len(points), UPSERT_BATCH_SIZE):
+                    await out_q.put(points[start:start + UPSERT_BATCH_SIZE])
+
+        async def embed_all():
+            await asyncio.gather(*[embed_worker() for _ in range(EMBED_CONCURRENCY)])
+            for _ in range(UPSERT_CONCURRENCY):
+                await out_q.put(None)
+
+        upserted = 0
+
+        async def upsert_worker():
+            nonlocal upserted
+            while (points := await out_q.get()) is not None:
+                await aclient.upsert(collection_name=self.collection_name, points=points, wait=False)
+                upserted += len(points)
+
+        tasks = []
+        try:
+            # Ids only cover this run's chunks, so overwriting alone would keep
+            # the tail chunks of shrunk files and every chunk of deleted ones
+            await aclient.delete(
+                collection_name=self.collection_name,
+                points_selector=models.FilterSelector(filter=self._search_filter(repo)),
+                wait=True
+            )
+            tasks = [asyncio.ensure_future(c) for c in
+                     [produce(), embed_all()] + [upsert_worker() for _ in range(UPSERT_CONCURRENCY)]]
+            await asyncio.gather(*tasks)
+        finally:
+            # A failed worker would leave the others blocked on the queues
+            for task in tasks:
+                task.cancel()
+            await aclient.close()
+        return upserted
+
+    async def aingest_codebase(self, path: str):
         if not self.vector_store:
-            print("RAG Engine not initialized, skipping ingestion.")
+            log.warning("RAG Engine not initialized, skipping ingestion.")
             return
 
-        print(f"Ingesting codebase from {path}...")
-        documents = []
+        log.info("Ingesting codebase from %s...", path)
         try:
-            from langchain_core.documents import Document
-            from langchain_text_splitters import RecursiveCharacterTextSplitter
-            
-            splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-            
-            for root, _, files in os.walk(path):
-                if any(x in root for x in ["node_modules", ".git", "__pycache__", "venv", "qdrant_data"]):
+            paths = _collect_paths(path)
+
+            # Reads are I/O bound, so threads let the OS overlap them
+            with ThreadPoolExecutor(max_workers=READ_WORKERS) as ex:
+                contents = list(ex.map(_read_file, paths))
+
+            repo = os.path.abspath(path)
+            # extension -> (texts, metadatas), so each splitter runs one batched call
+            groups = {}
+            for file_path, content in zip(paths, contents):
+                if content is None:
                     continue
-                    
-                for file in files:
-                    if file.endswith(('.py', '.js', '.html', '.css', '.md', '.txt', '.yml', '.json')):
-                        file_path = os.path.join(root, file)
-                        try:
-                            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                content = f.read()
-                            
-                            # Skip empty or very small files
-                            if len(content.strip()) < 10:
-                                continue
-                                
-                            docs = splitter.create_documents(
-                                [content], 
-                                metadatas=[{"source": file_path, "filename": file}]
-                            )
-                            documents.extend(docs)
-                        except Exception as e:
-                            print(f"Error processing {file_path}: {e}")
+                ext = os.path.splitext(file_path)[1]
+                texts, metadatas = groups.setdefault(ext, ([], []))
+                texts.append(content)
+                metadatas.append({
+                    "source": file_path,
+                    "repo": repo,
+                    "language": LANGUAGES.get(ext, "text"),
+                    "filename_ext": ext
+                })
+
+            documents = []
+            for ext, (texts, metadatas) in groups.items():
+                splitter = _SPLITTERS.get(ext, _splitter)
+                documents.extend(splitter.create_documents(texts, metadatas=metadatas))
             
             if documents:
-                print(f"Adding {len(documents)} document chunks to Qdrant...")
-                self.vector_store.add_documents(documents)
-                print("Ingestion complete.")
+                log.info("Embedding and adding %d document chunks to Qdrant...", len(documents))
+                # Build the HNSW index once after the upload rather than while points stream in
+                self._set_indexing_threshold(0)
+                try:
+                    upserted = await self._aembed_and_upsert(documents, repo)
+                finally:
+                    self._set_indexing_threshold(INDEXING_THRESHOLD)
+                    # Even a failed run may have upserted some points
+                    self.clear_result_cache()
+                if upserted != len(documents):
+                    log.error("Ingestion incomplete: upserted %d of %d chunks.", upserted, len(documents))
+                else:
+                    log.info("Ingestion complete: upserted %d chunks.", upserted)
             else:
-                print("No documents found to ingest.")
+                log.info("No documents found to ingest.")
                 
         except Exception as e:
-            print(f"Ingestion failed: {e}")
+            log.error("Ingestion failed: %s", e)
+
+    def _cached_result(self, key):
+        with self._results_lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def _store_result(self, key, result: str):
+        with self._results_lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+    def clear_result_cache(self):
+        """Drop cached results here and in every cache registered with on_index_change."""
+        with self._results_lock:
+            self._results.clear()
+        for listener in _index_listeners:
+            listener()
+
+    def embed_query(self, query: str):
+        """Embed a query, reusing the shared embedding cache for repeated text."""
+        return embed_with_cache(query, self.embeddings.embed_query)
+
+    def embed_queries(self, queries):
+        """Embed several queries with a single embedder call for the cache misses."""
+        return embed_many_with_cache(queries, self.embeddings.embed_documents)
+
+    @staticmethod
+    def _search_filter(repo=None, lang=None):
+        """Payload filter for the optional repo path / language restriction, or None."""
+        must = [
+            models.FieldCondition(key=key, match=models.MatchValue(value=value))
+            for key, value in (("metadata.repo", repo), ("metadata.language", lang))
+            if value is not None
+        ]
+        return models.Filter(must=must) if must else None
 
-    def search(self, query: str):
+    def _search_vector(self, vector, repo=None, lang=None):
+        results = self.client.search(
+            collection_name=self.collection_name,
+            query_vector=vector.tolist(),
+            query_filter=self._search_filter(repo, lang),
+            limit=5,
+            # Candidates come from the int8 vectors, then get rescored on the originals
+            search_params=models.SearchParams(
+                hnsw_ef=64,
+                quantization=models.QuantizationSearchParams(rescore=True)
+            )
+        )
+        return "\n\n".join(
+            f"Source: {res.payload['metadata']['source']}\nContent:\n{res.payload['page_content']}"
+            for res in results
+        )
+
+    def search(self, query: str, repo=None, lang=None):
         if not self.vector_store:
             return "RAG functionality is unavailable (init failed)."
+        key = (query, repo, lang)
+        result = self._cached_result(key)
+        if result is not None:
+            return result
         try:
-            results = self.vector_store.similarity_search(query, k=5)
-            return "\n\n".join([f"Source: {res.metadata['source']}\nContent:\n{res.page_content}" for res in results])
+            result = self._search_vector(self.embed_query(query), repo, lang)
         except Exception as e:
             return f"Search error: {e}"
+        self._store_result(key, result)
+        return result
+
+    def search_batch(self, queries, repo=None, lang=None, vectors=None):
+        """
+        Search several queries: one batched embedding pass, then one ANN lookup per uncached query.
+        Pass vectors (one per query) when the caller has already embedded them.
+        """
+        if not self.vector_store:
+            return ["RAG functionality is unavailable (init failed)."] * len(queries)
+        results = [self._cached_result((q, repo, lang)) for q in queries]
+        misses = [i for i, res in enumerate(results) if res is None]
+        if not misses:
+            return results
+        try:
+            if vectors is None:
+                miss_vectors = self.embed_queries([queries[i] for i in misses])
+            else:
+                miss_vectors = [vectors[i] for i in misses]
+        except Exception as e:
+            for i in misses:
+                results[i] = f"Search error: {e}"
+            return results
+        for i, vector in zip(misses, miss_vectors):
+            try:
+                results[i] = self._search_vector(vector, repo, lang)
+            except Exception as e:
+                results[i] = f"Search error: {e}"
+                continue
+            self._store_result((queries[i], repo, lang), results[i])
+        return results
 
-rag_engine = RAGEngine()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_rag_engine():
+    """
+    Shared RAGEngine, built on first use so importing this module doesn't
+    open a Qdrant connection or an OpenAI client.
+    """
+    return RAGEngine()
\ No newline at end of file